@@ -19,12 +19,18 @@
 # ***********************************************************************************
 import os
 import sys
+import json
 import getpass
-import geopandas as gpd
+import functools
+import datetime
 import asf_search as asf
+from shapely import wkt
+from shapely.geometry import shape
 import argparse
 import logging
 from logging.handlers import TimedRotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 import pandas as pd
 
@@ -37,6 +43,8 @@ CREDFILE= '.credentials'  # user:password for ASF (NASA Earthdata Alaska Facilit
 VERBOSE = False
 LOG_FILE = None
 LOG_LEVEL = 'INFO'
+WORKERS = 50  # number of concurrent downloads
+COLUMNS = ['url', 'fileName', 'bytes', 'sceneName', 'startTime', 'sizeMB']  # product properties kept from search results
 log = logging.getLogger('SentinelDL')
 log.setLevel(LOG_LEVEL)  # set at default log level
 
@@ -54,12 +62,28 @@ parser.add_argument('-t', '--track', metavar='Track Number', help=f'Track number
 parser.add_argument('-d', '--direction', help=f'Direction, default: Both', choices=['ASCENDING', 'DESCENDING'], default=None)
 parser.add_argument('--start', metavar='YYYY-MM-DD', help=f'Start date', required=True)
 parser.add_argument('--end', metavar='YYYY-MM-DD', help=f'End date', required=True)
-parser.add_argument('--geometry', metavar='geojson/shapefile', help=f'Region of interest polygon (WGS84)', required=True)
+parser.add_argument('--geometry', metavar='geojson/wkt/shapefile', help=f'Region of interest polygon (WGS84)', required=True)
+
+def read_credentials(credfile='.credentials'):
+    """Read user:password from the first line of a credentials file.
+    The file is read into a bytearray which is zeroed after parsing."""
+    if os.name == 'posix' and os.stat(credfile).st_mode & 0o077:
+        log.warning(f'Credential file {credfile} is accessible by other users. Consider: chmod 600 {credfile}')
+    with open(credfile, 'rb') as f:
+        buf = bytearray(f.read(4096))
+    try:
+        end = buf.find(b'\n')
+        end = len(buf) if end < 0 else end
+        colon = buf.index(b':', 0, end)
+        username = bytes(buf[:colon]).strip().decode()
+        password = bytes(buf[colon + 1:end]).strip().decode()
+    finally:
+        buf[:] = bytes(len(buf))  # clear the file content from memory
+    return username, password
 
 def get_auth(credfile='.credentials') -> dict:
     try:
-        with open(credfile, 'r') as f:
-            username, password = f.readline().strip().split(':')
+        username, password = read_credentials(credfile)
     except Exception as ex:
         print(f'Error with redential file: {credfile}. Please provide manually.')
         username = getpass.getpass("Enter your username")
@@ -71,6 +95,28 @@ def get_auth(credfile='.credentials') -> dict:
     return creds
 
 
+@functools.lru_cache(maxsize=None)  # read each file once for repeated searches
+def read_aoi(aoifile) -> str:
+    """Read the first geometry of a geojson, wkt or shapefile as WKT"""
+    ext = os.path.splitext(aoifile)[1].lower()
+    if ext in ['.geojson', '.json']:
+        with open(aoifile, 'r') as f:
+            geometry = json.load(f)
+        if geometry.get('type') == 'FeatureCollection':
+            geometry = geometry['features'][0]
+        if geometry.get('type') == 'Feature':
+            geometry = geometry['geometry']
+        geometry = shape(geometry)
+    elif ext == '.wkt':
+        with open(aoifile, 'r') as f:
+            geometry = wkt.loads(f.read())
+    else:
+        import fiona  # only needed for other file formats
+        with fiona.open(aoifile) as src:
+            geometry = shape(next(iter(src))['geometry'])
+    return wkt.dumps(geometry, rounding_precision=6)
+
+
 class ASFClient(object):
     'A scihub client class'
     def __init__(self, credfile=CREDFILE, datapath=DATAPATH):
@@ -78,6 +124,7 @@ class ASFClient(object):
         """
         self.credfile = credfile
         self.datapath = datapath
+        self.products = None  # last search results
         if not os.path.exists(self.datapath):
             log.debug(f'Creating {self.datapath}')
             os.makedirs(self.datapath, exist_ok=True)
@@ -91,6 +138,8 @@ class ASFClient(object):
 
     def search_S1_SLC_data(self, start_date="2011-01-01", end_date="2024-01-01", aoifile=None, direction=None,
                           track=None):
+        """Search ASF for Sentinel 1 SLC products.
+        Yields a DataFrame of new products for each page of results. All results are kept in self.products"""
         log.debug(f'Searching for {direction} data from {start_date} to {end_date} within geometry in {aoifile}' + (
             f' from track {track}' if track else ''))
         params = {}
@@ -98,32 +147,71 @@ class ASFClient(object):
         params['platform'] = asf.PLATFORM.SENTINEL1
         params['processingLevel'] = asf.PRODUCT_TYPE.SLC
         # time window
-        params['start'] = pd.to_datetime(start_date).isoformat() + 'Z'
-        params['end'] = pd.to_datetime(end_date).isoformat() + 'Z'
+        params['start'] = datetime.datetime.strptime(start_date, '%Y-%m-%d').strftime('%Y-%m-%dT%H:%M:%SZ')
+        params['end'] = datetime.datetime.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%dT%H:%M:%SZ')
         # geometry
         if aoifile is not None:
-            aoi = str(gpd.read_file(aoifile).geometry.values[0])
-            params['intersectsWith'] = aoi
+            params['intersectsWith'] = read_aoi(aoifile)
         # direction
         if direction in ['ASCENDING', 'DESCENDING']:
             params['flightDirection'] = direction
         if track is not None:
             params['relativeOrbit'] = track
-        results = asf.search(**params)
+        pages = []
+        seen = set()  # scene names of previous pages
+        complete = False
         try:
-            results.raise_if_incomplete()
+            for page in asf.search_generator(maxResults=None, **params):  # pages are yielded as they arrive
+                # keep only the needed properties, drop duplicate scenes and start with the largest products
+                products = pd.DataFrame([{'url': r.properties['url'],
+                                          'fileName': r.properties['fileName'],
+                                          'bytes': r.properties['bytes'],
+                                          'sceneName': r.properties['sceneName'],
+                                          'startTime': r.properties['startTime'],
+                                          'sizeMB': r.properties['bytes'] / 1e6} for r in page], columns=COLUMNS)
+                products = products[~products['sceneName'].isin(seen)]
+                products = products.drop_duplicates('sceneName').sort_values('sizeMB', ascending=False)
+                seen.update(products['sceneName'])
+                pages.append(products)
+                complete = page.searchComplete
+                yield products
         except Exception as EX:
-            log.error(f'Incomplete search: {EX}')
-            return None
-        log.info(f"Found {len(results)} records.")
-        return results
+            log.error(f'Search failed: {EX}')
+        if not complete:
+            log.error('Incomplete search')
+        self.products = pd.concat(pages) if pages else pd.DataFrame(columns=COLUMNS)
+        log.info(f"Found {len(self.products)} records.")
 
-    def download_all(self, results):
-        """Download search results data from ASF server"""
-        results.download(
-            path=self.datapath,
-            session=self.session,
-            processes=50)
+    def download_all(self, products, workers=WORKERS):
+        """Download search results data from ASF server.
+        products is a DataFrame or an iterable of DataFrames, e.g. search pages, downloaded as they arrive.
+        Downloads are I/O bound, so they run in threads sharing the authenticated session.
+        Products already downloaded to datapath are skipped before opening any connection.
+        On interrupt, queued downloads are cancelled."""
+        if isinstance(products, pd.DataFrame):
+            products = [products]
+        existing = {f.name: f.stat().st_size for f in os.scandir(self.datapath) if f.is_file()}
+        self.session.mount('https://', HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {}
+            for page in products:
+                done = page['fileName'].map(existing) == page['bytes']
+                if done.any():
+                    log.info(f'{done.sum()} products already downloaded. skipping.')
+                page = page[~done]
+                futures.update({executor.submit(asf.download_url, url=url, path=self.datapath, filename=filename,
+                                                session=self.session): url
+                                for url, filename in zip(page['url'], page['fileName'])})
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as EX:
+                    log.error(f"Failed to download {futures[future]}: {EX}")
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)  # don't start queued downloads on interrupt
+            raise
+        executor.shutdown()
 
 
 def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
@@ -133,8 +221,9 @@ def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
         ch = logging.StreamHandler(sys.stdout)
         ch.setLevel(log_level)
         ch.setFormatter(formatter)
-        if logging.StreamHandler not in [h.__class__ for h in log.handlers]:
+        if not getattr(log, '_sentinel_stream_added', False):
             log.addHandler(ch)
+            log._sentinel_stream_added = True
         else:
             log.warning('log Stream handler already applied.')
     if logfile:
@@ -144,8 +233,9 @@ def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
                                       utc=True)
         fh.setLevel(log_level)
         fh.setFormatter(formatter)
-        if TimedRotatingFileHandler not in [h.__class__ for h in log.handlers]:
+        if not getattr(log, '_sentinel_file_added', False):
             log.addHandler(fh)
+            log._sentinel_file_added = True
         else:
             log.warning('Log file handler already applied.')
         log.info(f'Log file is: {logfile}')
@@ -168,6 +258,7 @@ Test:
 args = parser.parse_args("--start 2023-09-01 --end 2023-11-01 --geometry NOVA.geojson -d ASCENDING -t 87".split())
 set_logger(log, True, 'DEBUG', args.logfile)
 self = client = ASFClient() # create a client
-records = client.search_S1_SLC_data(start_date=args.start, end_date=args.end, aoifile=args.geometry, direction=args.direction, track=args.track)
+pages = list(client.search_S1_SLC_data(start_date=args.start, end_date=args.end, aoifile=args.geometry, direction=args.direction, track=args.track))
+records = client.products
 
 """
@@ -17,8 +17,14 @@
 # *    You should have received a copy of the GNU Lesser General Public License     *
 # *    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
 # ***********************************************************************************
-import os, sys, requests, time, datetime, subprocess, getpass
-import geopandas as gpd
+import os, sys, requests, time, shutil, signal, getpass, threading, functools, json
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from email.message import Message
+from urllib.parse import urlencode, quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from shapely import wkt
+from shapely.geometry import shape
 import argparse
 import logging
 from logging.handlers import TimedRotatingFileHandler
@@ -31,12 +37,31 @@ formatter = logging.Formatter(fmt='%(asctime)s.%(msecs)03d | %(name)s | %(leveln
 DATAPATH = 'data'  # where to save the data
 AUXPATH = 'AUX'  # where to save the auxillary data
 CREDFILE= '.credentials'  # user:password for scihub
+CATALOGUE_URL = 'https://catalogue.dataspace.copernicus.eu/odata/v1/Products'  # products search
 VERBOSE = False
 LOG_FILE = None
 LOG_LEVEL = 'INFO'
+MAX_CONNECTIONS = 4  # dataspace allows 4 concurrent downloads per user
+JOBS = 4  # number of products downloaded in parallel
+NUM_CHUNKS = None  # number of parallel byte-range requests per product, default: MAX_CONNECTIONS // jobs
+MAX_CHUNKS = 16  # upper limit for parallel byte-range requests
+MIN_CHUNK_SIZE = 8 * 1048576  # don't split files into ranges smaller than 8 MB
+BLOCKSIZE = 131072  # read block size of a byte-range request
+WRITESIZE = 4 * 1048576  # collect blocks of a byte-range request into 4 MB writes
+STREAMSIZE = 8 * 1048576  # read size of a single stream download
+CACHESIZE = 64 * 1048576  # drop downloaded data from the page cache every 64 MB
+TIMEFMT = "%Y%m%dT%H:%M:%S"  # time format of progress messages
 log = logging.getLogger('SentinelDL')
 log.setLevel(LOG_LEVEL)  # set at default log level
 
+def positive_int(value):
+    """argparse type of integers of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description='''Search and Download Sentinel 1 data from dataspace.copernicus.eu''',
@@ -52,13 +77,53 @@ parser.add_argument('-d', '--direction', help=f'Direction, default: Both', choic
 parser.add_argument('-o', '--online', action='store_true', help=f'Only get data available online, not from archive', default=False)
 parser.add_argument('--start', metavar='YYYY-MM-DD', help=f'Start date', required=True)
 parser.add_argument('--end', metavar='YYYY-MM-DD', help=f'End date', required=True)
-parser.add_argument('--geometry', metavar='geojson/shapefile', help=f'Region of interest polygon (WGS84)', required=True)
+parser.add_argument('--geometry', metavar='geojson/wkt/shapefile', help=f'Region of interest polygon (WGS84)', required=True)
+parser.add_argument('--ca-bundle', metavar='PATH', help='CA certificates bundle for TLS verification (e.g. behind a proxy), default: certifi bundle', default=None)
+parser.add_argument('-j', '--jobs', metavar='N', type=positive_int, help=f'Number of products to download in parallel, default: {JOBS}', default=JOBS)
+parser.add_argument('--segments', metavar='N', type=positive_int, help=f'Number of parallel byte-range requests per product (1 to disable, max {MAX_CHUNKS}), default: {MAX_CONNECTIONS} / jobs', default=NUM_CHUNKS)
 parser.add_argument('-a', '--aux', action='store_true', help=f'Download state vectore auxillary files. Default: {AUXPATH}', default=False)
 
-def get_keycloak(credfile='.credentials') -> str:
+def read_credentials(credfile='.credentials'):
+    """Read user:password from the first line of a credentials file.
+    The file is read into a bytearray which is zeroed after parsing."""
+    if os.name == 'posix' and os.stat(credfile).st_mode & 0o077:
+        log.warning(f'Credential file {credfile} is accessible by other users. Consider: chmod 600 {credfile}')
+    with open(credfile, 'rb') as f:
+        buf = bytearray(f.read(4096))
+    try:
+        end = buf.find(b'\n')
+        end = len(buf) if end < 0 else end
+        colon = buf.index(b':', 0, end)
+        username = bytes(buf[:colon]).strip().decode()
+        password = bytes(buf[colon + 1:end]).strip().decode()
+    finally:
+        buf[:] = bytes(len(buf))  # clear the file content from memory
+    return username, password
+
+@functools.lru_cache(maxsize=None)  # read each file once for repeated searches
+def read_aoi(aoifile) -> str:
+    """Read the first geometry of a geojson, wkt or shapefile as WKT"""
+    ext = os.path.splitext(aoifile)[1].lower()
+    if ext in ['.geojson', '.json']:
+        with open(aoifile, 'r') as f:
+            geometry = json.load(f)
+        if geometry.get('type') == 'FeatureCollection':
+            geometry = geometry['features'][0]
+        if geometry.get('type') == 'Feature':
+            geometry = geometry['geometry']
+        geometry = shape(geometry)
+    elif ext == '.wkt':
+        with open(aoifile, 'r') as f:
+            geometry = wkt.loads(f.read())
+    else:
+        import fiona  # only needed for other file formats
+        with fiona.open(aoifile) as src:
+            geometry = shape(next(iter(src))['geometry'])
+    return wkt.dumps(geometry, rounding_precision=6)
+
+def get_keycloak(credfile='.credentials', session=None) -> dict:
     try:
-        with open(credfile, 'r') as f:
-            username, password = f.readline().strip().split(':')
+        username, password = read_credentials(credfile)
     except Exception as ex:
         print(f'Error with redential file: {credfile}. Please provide manually.')
         username = getpass.getpass("Enter your username")
@@ -69,171 +134,515 @@ def get_keycloak(credfile='.credentials') -> str:
         "password": password,
         "grant_type": "password",
     }
+    r = None
     try:
-        r = requests.post(
+        r = (session or requests).post(
         "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token",
         data=data,
+        timeout=(5, 30),
         )
         r.raise_for_status()
+        return r.json()
     except Exception as e:
         raise Exception(
-        f"Keycloak token creation failed. Reponse from the server was: {r.json()}"
-        )
-    return r.json(), datetime.datetime.utcnow()
+        f"Keycloak token creation failed: {e}" + (f". Reponse from the server was: {r.text}" if r is not None else '')
+        ) from e
 
+@functools.lru_cache(maxsize=None)  # stdin doesn't change, check it once
 def isTTY():
     if os.isatty(sys.stdin.fileno()):
         return True
     else:
         return False
 
-def message(msg, newline=False, x=1000):
-    """Print messages to terminal"""
+_termsize = shutil.get_terminal_size((80, 1000))  # size of the terminal, default to 80 columns and last line
+_last_message = 0.  # time of last progress message
+
+
+def _refresh_termsize(*args):
+    """Update the cached terminal size when the terminal is resized"""
+    global _termsize
+    _termsize = shutil.get_terminal_size((80, 1000))
+
+
+if hasattr(signal, 'SIGWINCH'):  # not available on windows
+    signal.signal(signal.SIGWINCH, _refresh_termsize)
+
+
+def message(msg, newline=False):
+    """Print messages to terminal. Progress messages (no newline) are limited to 10 per second"""
+    global _last_message
     if not isTTY():
         return
-    try: # this will only work on Linux xos and cygwin
-        rows, columns = [int(i) for i in subprocess.check_output(['stty', 'size']).split()] # get the size of the terminal
-    except:
-        rows = x # just use the last line of the terminal
-        columns = 80 # and assume default line length
+    now = time.monotonic()
+    if not newline and now - _last_message < 0.1:
+        return
+    _last_message = now
+    columns, rows = _termsize
     if not newline: # clear last line and print message. might be buggy when on windows and terminal is smaller than default (80 columns)
         msg = "\x1b7\x1b[%d;%df\033[2K%s\x1b8" % (rows+100, 0, msg[-columns+1:]) # use terminal ascii escape codes
     sys.stderr.write(msg[-columns+1:]) # write to standard error
     sys.stderr.flush() # flush stderr - physically print to terminal.
 
 
+_timestamp = [0, '']  # last second and its formatted progress time
+
+
+def timestamp():
+    """Current time for progress messages, formatted once per second"""
+    now = int(time.time())
+    if now != _timestamp[0]:
+        _timestamp[:] = [now, time.strftime(TIMEFMT, time.localtime(now))]
+    return _timestamp[1]
+
+
+def hms(seconds):
+    """Format seconds as H:MM:SS.mmm"""
+    h, ms = divmod(int(seconds * 1000), 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f'{h:d}:{m:02d}:{s:02d}.{ms:03d}'
+
+
+def drop_cache(fd, offset=0, length=0):
+    """Write file data to disk and drop it from the page cache. Downloaded files are not read again.
+    length 0 means to the end of the file"""
+    getattr(os, 'fdatasync', os.fsync)(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def get_filename(headers):
+    """Get the file name from the Content-Disposition header, including RFC 2231/5987 encoded names.
+    Returns None if there is no file name"""
+    if 'Content-Disposition' not in headers:
+        return None
+    msg = Message()
+    msg['Content-Disposition'] = headers.get('Content-Disposition')
+    filename = msg.get_filename()
+    return os.path.basename(filename) if filename else None
+
+
+def retry_after(ex, default=60):
+    """Seconds to wait before retrying after an error. Uses the Retry-After header of a rejected request"""
+    resp = getattr(ex, 'response', None)
+    value = resp.headers.get('Retry-After', '') if resp is not None else ''
+    return int(value) if value.isdigit() else default
+
+
+def save_ranges(statename, fd, size, ranges, done):
+    """Save the byte ranges of a parallel download and the bytes of each already written to disk"""
+    state = {'size': size, 'ranges': ranges, 'done': list(done)}  # count bytes before syncing them
+    getattr(os, 'fdatasync', os.fsync)(fd)
+    with open(statename + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(statename + '.tmp', statename)
+
+
+class RangesIgnored(IOError):
+    """The server answered a byte range request with the whole file"""
+
+
 class SciHubClient(object):
     'A scihub client class'
-    def __init__(self, credfile=CREDFILE, datapath=DATAPATH):
+    def __init__(self, credfile=CREDFILE, datapath=DATAPATH, jobs=JOBS, ca_bundle=None, segments=NUM_CHUNKS):
         """Create the url opener and site authentication.
         """
         self.credfile = credfile
         self.datapath = datapath
+        self.jobs = jobs  # number of products to download in parallel
+        if segments is None:  # keep all connections within the per user limit
+            segments = max(1, MAX_CONNECTIONS // jobs)
+        if jobs * segments > MAX_CONNECTIONS:
+            log.warning(f'{jobs} jobs of {segments} segments open more than the {MAX_CONNECTIONS} concurrent downloads allowed per user')
+        self.segments = segments  # number of parallel byte-range requests per product
+        self.token_lock = threading.Lock()  # token renewal is shared by all download threads
+        self.seen = set()  # Ids of products already handled by this client
+        self.stop = threading.Event()  # set on interrupt, tells running downloads to stop
+        self.session = requests.Session()  # session for the scihub web server, keeps connections alive
+        self._auth_session = requests.Session()  # session for the identity server, reused for token renewal
+        self._auth_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        if ca_bundle:
+            self.session.verify = self._auth_session.verify = ca_bundle  # verify TLS with a custom CA bundle
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(jobs * min(segments, MAX_CHUNKS), 2 * jobs),
+                              max_retries=Retry(total=5, connect=5, read=5, backoff_factor=2,
+                                                status_forcelist=(408, 429, 500, 502, 503, 504),
+                                                allowed_methods=frozenset(['HEAD', 'GET']),
+                                                raise_on_status=False, respect_retry_after_header=True))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.get_token()
 
     def get_token(self):
-        self.token, self.tokentime = get_keycloak(self.credfile)
-        self.headers = {"Authorization": f"Bearer {self.token['access_token']}"}
-        self.session = requests.Session()
-        self.session.headers.update({"Authorization": f"Bearer {self.token['access_token']}"}) # session for the scihub web server
-
-    @property
-    def renew(self):
-        if datetime.datetime.utcnow() > self.tokentime + datetime.timedelta(seconds=600):
-            log.debug('Token refresh')
-            self.get_token()
-            return True
-        else:
-            return False
+        self.token = get_keycloak(self.credfile, session=self._auth_session)
+        self.token_deadline = time.monotonic() + self.token.get('expires_in', 600) - 60  # renew a minute before expiry
+        self.session.headers.update({"Authorization": f"Bearer {self.token['access_token']}"})
+
+    def _ensure_token(self):
+        """Renew the access token if it is about to expire. Returns True if renewed"""
+        with self.token_lock:
+            if time.monotonic() >= self.token_deadline:
+                log.debug('Token refresh')
+                self.get_token()
+                return True
+            else:
+                return False
 
     def search_S1_SLC_data(self, start_date="2023-09-01", end_date="2023-11-01", aoifile='NOVA.geojson', direction=None,
                           track=None, online=False):
         log.debug(f'Searching for {direction} data from {start_date} to {end_date} within geometry in {aoifile}' + (
             f' from track {track}' if track else ''))
-        aoi = str(gpd.read_file(aoifile).geometry.values[0])
+        filters = ["startswith(Name,'S1')",
+                   "Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'instrumentShortName' and att/OData.CSC.StringAttribute/Value eq 'SAR')",
+                   "contains(Name,'SLC')",
+                   f"OData.CSC.Intersects(area=geography'SRID=4326;{read_aoi(aoifile)}')"]
         if online:
-            online = " and Online eq true"
+            filters.append("Online eq true")
         if direction in ['ASCENDING', 'DESCENDING']:
-            direction = f" and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'orbitDirection' and att/OData.CSC.StringAttribute/Value eq '{direction}')"
+            filters.append(f"Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'orbitDirection' and att/OData.CSC.StringAttribute/Value eq '{direction}')")
         if track is not None:
-            track = f" and Attributes/OData.CSC.IntegerAttribute/any(att:att/Name eq 'relativeOrbitNumber' and att/OData.CSC.IntegerAttribute/Value eq {track})"
-        resp = self.session.get(
-           f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=(startswith(Name,'S1') and ((Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'instrumentShortName' and att/OData.CSC.StringAttribute/Value eq 'SAR') and (contains(Name,'SLC') and OData.CSC.Intersects(area=geography'SRID=4326;{aoi}'))){online}{direction}{track})) and ContentDate/Start gt {start_date}T00:00:00.000Z and ContentDate/Start lt {end_date}T00:00:00.000Z&$expand=Attributes&$count=True&$expand=Assets&$skip=0"
-        ).json()
-        log.info(f"Found {resp['@odata.count']} records.")
-        return resp
+            filters.append(f"Attributes/OData.CSC.IntegerAttribute/any(att:att/Name eq 'relativeOrbitNumber' and att/OData.CSC.IntegerAttribute/Value eq {track})")
+        return self.search(filters, start_date, end_date)
 
     def search_S1_SLC_OPER(self, start_date="2023-09-01", end_date="2023-11-01"):
         log.debug(f'Searching for aux data from {start_date} to {end_date}')
-        resp = self.session.get(
-           f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=(startswith(Name,'S1') and contains(Name,'AUX_POEORB') and Online eq true) and ContentDate/Start gt {start_date}T00:00:00.000Z and ContentDate/Start lt {end_date}T00:00:00.000Z&$expand=Attributes&$count=True&$expand=Assets&$skip=0"
-        ).json()
-        log.info(f"Found {len(resp['value'])} records.")
-        return resp
-
-    def download(self, Id):
-        """Download data from scihub server"""
+        return self.search(["startswith(Name,'S1')", "contains(Name,'AUX_POEORB')", "Online eq true"], start_date, end_date)
+
+    def search(self, filters, start_date, end_date):
+        """Search the catalogue for products sensed between start_date and end_date matching all filters.
+        Yields product records page by page, so downloads can start before the search is done."""
+        filters = filters + [f"ContentDate/Start gt {start_date}T00:00:00.000Z",
+                             f"ContentDate/Start lt {end_date}T00:00:00.000Z"]
+        query = urlencode({'$filter': ' and '.join(filters),
+                           '$expand': ['Attributes', 'Assets'],
+                           '$count': 'True',
+                           '$top': 1000,
+                           '$skip': 0}, doseq=True, quote_via=quote, safe="$'(),/:")  # encode spaces as %20 for OData
+        url = CATALOGUE_URL
+        first = True
+        while url:
+            try:
+                self._ensure_token()
+                resp = self.session.get(url, params=query, timeout=600)
+                resp.raise_for_status()
+                resp = resp.json()
+            except Exception as Ex:
+                log.error(f'Search failed: {Ex}')
+                return
+            if first:
+                log.info(f"Found {resp.get('@odata.count', len(resp['value']))} records.")
+                first = False
+            yield from resp['value']
+            url, query = resp.get('@odata.nextLink'), None  # the next link has the full query
+
+    def download_all(self, records):
+        """Download the products of search records, each product Id only once.
+        Up to self.jobs products are downloaded in parallel. On interrupt, queued products are
+        cancelled and running downloads are stopped."""
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            futures = {}
+            for record in records:
+                if record['Id'] in self.seen:
+                    log.debug(f"{record['Name']}: Duplicate record. skipping.")
+                    continue
+                self.seen.add(record['Id'])
+                futures[executor.submit(self._download_and_rest, record['Id'])] = record['Name']
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as Ex:
+                    log.error(f'{futures[future]}: {Ex}')
+        except BaseException:
+            self.stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    def _download_and_rest(self, Id):
+        """Download a product and have a short resting time before the next one.
+        There is no rest after a product which was already downloaded"""
+        result = self.download(Id)
+        if result != 2:
+            self.stop.wait(60)
+        return result
+
+    def download(self, Id, num_chunks=None):
+        """Download data from scihub server.
+        If the server accepts byte ranges, a new file is downloaded in num_chunks (default: self.segments) parallel parts.
+        Returns 1 when downloaded, 2 when it was already downloaded and 0 on failure."""
         url = f"https://zipper.dataspace.copernicus.eu/odata/v1/Products({Id})/$value"
+        if self.stop.is_set():
+            return 0
         try:
-            self.renew
-            DLf = self.session.get(url, headers=self.headers, stream=True, allow_redirects=True, timeout=600) # open url, get the data file
+            self._ensure_token()
+            DLf = self.session.head(url, allow_redirects=True, timeout=60)  # get the file details without the data
             DLf.raise_for_status()
         except Exception as Ex:
-            log.error(f'Error opening URL {url}\n{Ex}')
-            return 0
+            log.debug(f'HEAD {url} failed, trying GET\n{Ex}')
+            DLf = None
+        if DLf is None or 'Content-Disposition' not in DLf.headers or 'Content-Length' not in DLf.headers:
+            try:
+                DLf = None
+                DLf = self.session.get(url, stream=True, allow_redirects=True, timeout=600)  # open url, get the data file
+                DLf.raise_for_status()
+            except Exception as Ex:
+                if DLf is not None:
+                    DLf.close()
+                log.error(f'Error opening URL {url}\n{Ex}')
+                return 0
         if not DLf:
             return 0  # make sure we have a connection to a file
         fsize = 0  # placeholder for file size
-        DLname = self.datapath + os.sep + DLf.headers.get('Content-Disposition').split("=")[-1].strip().replace('"','')  # get file name
-        DLsize = int(DLf.headers.get('Content-Length'))  # get file size
+        filename = get_filename(DLf.headers)  # get file name
+        if not filename or not DLf.headers.get('Content-Length', '').isdigit():
+            DLf.close()
+            log.error(f'Error opening URL {url}\nNo file name or size in the server response')
+            return 0
+        DLname = self.datapath + os.sep + filename
+        DLsize = int(DLf.headers['Content-Length'])  # get file size
         log.info(f'{DLname}: {DLsize/1048576.:.2f} MB')  # sent name and size to terminal
         if os.path.exists(DLname):  # check if same name file exists on current location
             fsize = os.path.getsize(DLname)  # if so, what is its size
-            DLf.close()
             if fsize == DLsize:  # make sure we did't download the file before
+                DLf.close()
                 log.info(f'{DLname}: Already downloaded. skipping.')
-                return 1
-            log.info("Starting form {}".format(fsize))
+                return 2
+        num_chunks = max(1, min(num_chunks or self.segments, MAX_CHUNKS, DLsize // MIN_CHUNK_SIZE))
+        if fsize == 0 and (num_chunks > 1 or os.path.exists(DLname + '.part')) and hasattr(os, 'pwrite') and \
+                DLf.headers.get('Accept-Ranges', '').lower() == 'bytes':
+            DLf.close()
             try:
-                time.sleep(60)
-                self.renew
-                self.session.headers.update({"Range": f"bytes={fsize}-"})  # set opener to start from current point
-                DLf = self.session.get(url, headers=self.session.headers, stream=True, allow_redirects=True, timeout=600) # reopen url, from last point
-                DLf.raise_for_status()
-            except Exception as Ex:
-                log.error(f'Error opening URL {url}\n{Ex}')
-                return 0
+                return self.download_ranges(url, DLname, DLsize, num_chunks)
+            except RangesIgnored as Ex:
+                log.warning(f'{DLname}: {Ex}. Downloading in a single stream')
+                DLf = None
+        if DLf is not None and (fsize or DLf.request.method == 'HEAD'):  # the data file is opened below, from last point if resuming
+            if fsize:
+                log.info("Starting form {}".format(fsize))
+            DLf.close()
+            DLf = None
         starttime = time.time() # get download start time
         tryouts = 0
-        while tryouts < 5 and ((not os.path.exists(DLname)) or (os.path.getsize(DLname) < DLsize)):
+        while fsize < DLsize:
             try:
-                if tryouts > 0:
-                    log.info(f'Retry ({tryouts}/5)...')
-                DLt = 0
-                for data in DLf.iter_content(chunk_size=1048576):  # read a 1 MB piece of data
-                    steptime = time.time()
-                    with open(DLname, 'ab') as outfile:  # open the output file for writing
-                        if data:
-                            outfile.write(data)
-                            if os.path.exists(DLname):
-                                fsize = os.path.getsize(DLname)
-                            else:
-                                fsize = 0
-                            NOW = time.time()
-                            DLt = NOW - starttime  # calculate time since starting to download
-                            DLstep = NOW - steptime  # calculate time to download segment
-                            if DLt and DLstep:
-                                DLrate = (len(data) / 1048576.) / DLstep  # calculate current download rate
-                                ETA = (DLsize - fsize) / (DLrate * 1048576)  # Estimate Arrival Time in seconds
-                                ETA = str(datetime.datetime.fromtimestamp(ETA) - datetime.datetime.fromtimestamp(0))[
-                                      :-3]  # reformat ETA for humans.
-                            else:
-                                DLrate = 0
-                                ETA = 'N/A'
-                            message('%s| %d%% @ %.2f sec (%.2f MB/sec) ETA: %s' \
-                                    % (datetime.datetime.now().strftime("%Y%m%dT%H:%M:%S"),
-                                       fsize / float(DLsize) * 100, DLt, DLrate,
-                                       ETA))  # print some statistics to terminal
-                message('%s| %d%% @ %.2f sec\n' \
-                                % (datetime.datetime.now().strftime("%Y%m%dT%H:%M:%S"),
-                                fsize / float(DLsize) * 100, DLt))  # print final statistics to terminal
-                DLf.close()
-            except Exception as Ex:
-                log.error(f'{Ex}')
-                DLf.close()
+                if DLf is None:  # connection failures and server errors are retried by the session adapter
+                    self._ensure_token()
+                    DLf = self.session.get(url, headers={"Range": f"bytes={fsize}-"} if fsize else None, stream=True,
+                                           allow_redirects=True, timeout=600)  # open url, from last point
+                    DLf.raise_for_status()
+                DLf.raw.decode_content = False  # products are zip files, read the bytes as they are
+                with open(DLname, 'ab') as outfile:  # open the output file for writing
+                    progress = isTTY() and self.jobs == 1  # progress lines of parallel products would overwrite each other
+                    logged = fsize * 10 // DLsize  # last 10% step logged
+                    DLrate = None  # exponentially weighted download rate
+                    steptime = lastprint = time.time()
+                    percent = 100. / DLsize  # percent of file per byte
+                    lastpercent = int(fsize * percent)  # last percent printed
+                    cached = fsize  # file size when the page cache was last dropped
+                    for data in DLf.raw.stream(STREAMSIZE, decode_content=False):  # read an 8 MB piece of data
+                        if self.stop.is_set():
+                            break
+                        outfile.write(data)
+                        fsize += len(data)
+                        if fsize - cached >= CACHESIZE:
+                            outfile.flush()
+                            drop_cache(outfile.fileno())
+                            cached = fsize
+                        NOW = time.time()
+                        DLstep = NOW - steptime  # calculate time to download segment
+                        steptime = NOW
+                        if DLstep:
+                            rate = (len(data) / 1048576.) / DLstep  # calculate current download rate
+                            DLrate = rate if DLrate is None else 0.9 * DLrate + 0.1 * rate
+                        if self.jobs > 1:
+                            if fsize * 10 // DLsize > logged:
+                                logged = fsize * 10 // DLsize
+                                log.info(f'{DLname}: {logged * 10}% ({DLrate or 0:.2f} MB/sec)')
+                            continue
+                        if not progress or NOW - lastprint < 0.5 and int(fsize * percent) == lastpercent:
+                            continue  # only format statistics every 0.5 sec or 1%
+                        lastprint = NOW
+                        lastpercent = int(fsize * percent)
+                        outfile.flush()  # keep the file size on disk in line with the progress
+                        DLt = NOW - starttime  # calculate time since starting to download
+                        if DLrate:
+                            ETA = hms((DLsize - fsize) / (DLrate * 1048576))  # Estimate Arrival Time for humans
+                        else:
+                            ETA = 'N/A'
+                        message('%s| %d%% @ %.2f sec (%.2f MB/sec) ETA: %s' \
+                                % (timestamp(), lastpercent, DLt, DLrate or 0,
+                                   ETA))  # print some statistics to terminal
+                    if progress:
+                        message('%s| %d%% @ %.2f sec\n' \
+                                % (timestamp(),
+                                   fsize * percent, time.time() - starttime), newline=True)  # print final statistics to terminal
+                    outfile.flush()
+                    drop_cache(outfile.fileno())  # make sure the data is on disk
+                    fsize = outfile.tell()
+                if fsize < DLsize:
+                    raise IOError(f'Connection closed at byte {fsize} of {DLsize}')
+            except Exception as Ex:  # resume a broken stream from the last point
+                if self.stop.is_set():
+                    break
+                if isinstance(Ex, requests.exceptions.HTTPError) and Ex.response.status_code != 429:
+                    log.error(f'Error opening URL {url}\n{Ex}')
+                    break
                 tryouts += 1
-                time.sleep(60)  # have a short resting time
-                self.renew
-                fsize = os.path.getsize(DLname)
-                self.session.headers.update({"Range": f"bytes={fsize}-"})  # set opener to start from current point
-                DLf = self.session.get(url, headers=self.session.headers, stream=True,
-                                       allow_redirects=True, timeout=600)  # reopen url, from last point
-        if os.path.getsize(DLname) == DLsize:
+                if tryouts >= 5:
+                    log.error(f'{Ex}')
+                    break
+                log.warning(f'{Ex}. Retry ({tryouts}/5)...')
+                if self.stop.wait(retry_after(Ex)):  # have a short resting time
+                    break
+                fsize = os.path.getsize(DLname) if os.path.exists(DLname) else 0
+            finally:
+                if DLf is not None:
+                    DLf.close()
+                    DLf = None
+        if fsize == DLsize:
+            log.info(f'{DLname}: Downloaded.')
             return 1
+        elif self.stop.is_set():
+            log.warning(f'{DLname}: Download interrupted.')
+            return 0
         else:
             log.error('Failed to download all the file')
             return 0
 
+    def download_ranges(self, url, DLname, DLsize, num_chunks=MAX_CONNECTIONS):
+        """Download data from scihub server using parallel byte-range requests.
+        Parts are written in place to a temporary file which is renamed to DLname when complete.
+        The progress of the parts is kept next to the temporary file, so a failed download is resumed."""
+        partname = DLname + '.part'
+        statename = partname + '.json'  # byte ranges and bytes downloaded of each
+        ranges = done = None
+        if os.path.exists(partname):
+            try:
+                with open(statename, 'r') as f:
+                    state = json.load(f)
+                if state['size'] == DLsize and len(state['ranges']) == len(state['done']):
+                    ranges, done = [tuple(r) for r in state['ranges']], state['done']
+                    log.info(f'{DLname}: Resuming from {sum(done)} bytes')
+                else:
+                    log.warning(f'{partname}: Saved state is for {state["size"]} bytes, not {DLsize}. Starting over')
+            except (OSError, ValueError, KeyError, TypeError) as Ex:
+                log.warning(f'{partname}: Cannot resume ({Ex}). Starting over')
+        if ranges is None:
+            step = -(-DLsize // num_chunks)  # chunk size, rounded up
+            ranges = [(lo, min(lo + step, DLsize) - 1) for lo in range(0, DLsize, step)]
+            done = [0] * len(ranges)  # bytes downloaded by each part
+        log.debug(f'{DLname}: Downloading in {len(ranges)} parts')
+        abort = threading.Event()  # tell other parts to stop if one fails
+        resumed = sum(done)
+        fd = os.open(partname, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, DLsize)  # cut a stale part file of a different size
+            if hasattr(os, 'posix_fallocate'):  # reserve contiguous disk space for all parts
+                os.posix_fallocate(fd, 0, DLsize)
+            starttime = saved = time.time()  # get download start time
+            logged = 0  # last 10% step logged
+            try:
+                with ThreadPoolExecutor(max_workers=num_chunks) as executor:
+                    pending = {executor.submit(self._download_range, url, fd, lo, hi, done, i, abort)
+                               for i, (lo, hi) in enumerate(ranges) if lo + done[i] <= hi}
+                    try:
+                        while pending:
+                            finished, pending = wait(pending, timeout=1)
+                            for future in finished:
+                                future.result()  # raise errors of failed parts
+                            if self.stop.is_set():
+                                raise InterruptedError('Download interrupted')
+                            fsize = sum(done)
+                            NOW = time.time()
+                            if NOW - saved >= 10:  # save the progress of data already on disk
+                                save_ranges(statename, fd, DLsize, ranges, done)
+                                saved = NOW
+                            DLt = NOW - starttime  # calculate time since starting to download
+                            DLrate = ((fsize - resumed) / 1048576.) / DLt if DLt else 0  # calculate average download rate
+                            if self.jobs > 1:  # progress lines of parallel products would overwrite each other
+                                if fsize * 10 // DLsize > logged:
+                                    logged = fsize * 10 // DLsize
+                                    log.info(f'{DLname}: {logged * 10}% ({DLrate:.2f} MB/sec)')
+                                continue
+                            message('%s| %d%% @ %.2f sec (%.2f MB/sec)' \
+                                    % (timestamp(),
+                                       fsize / float(DLsize) * 100, DLt, DLrate))  # print some statistics to terminal
+                    except BaseException:
+                        abort.set()
+                        raise
+            except BaseException:
+                save_ranges(statename, fd, DLsize, ranges, done)  # all parts stopped, keep their progress
+                raise
+            drop_cache(fd)  # make sure the data is on disk before renaming
+            if not os.fstat(fd).st_size == DLsize == sum(done):
+                raise IOError(f'{partname} has {os.fstat(fd).st_size} bytes, {sum(done)} downloaded of {DLsize}')
+            if self.jobs == 1:
+                message('%s| %d%% @ %.2f sec\n' \
+                        % (timestamp(),
+                           sum(done) / float(DLsize) * 100, time.time() - starttime), newline=True)  # print final statistics to terminal
+        except RangesIgnored:
+            os.remove(partname)  # the parts can't be resumed without byte ranges
+            if os.path.exists(statename):
+                os.remove(statename)
+            raise
+        except Exception as Ex:
+            if self.stop.is_set():
+                log.warning(f'{DLname}: Download interrupted.')
+            else:
+                log.error(f'Failed to download all the file\n{Ex}')
+            return 0
+        finally:
+            os.close(fd)
+        os.replace(partname, DLname)
+        if os.path.exists(statename):
+            os.remove(statename)
+        log.info(f'{DLname}: Downloaded.')
+        return 1
+
+    def _download_range(self, url, fd, lo, hi, done, i, abort):
+        """Download bytes lo-hi of url and write them at the same offset of file descriptor fd.
+        Download starts after the done[i] bytes already written."""
+        offset = cached = lo + done[i]  # cached is the offset up to which the page cache was dropped
+        tryouts = 0
+        while offset <= hi and not abort.is_set():
+            try:
+                DLf = self.session.get(url, headers={'Range': f'bytes={offset}-{hi}'}, stream=True,
+                                       allow_redirects=True, timeout=600)
+                buf = bytearray()  # write buffer, saves a system call per block
+                try:
+                    DLf.raise_for_status()
+                    if DLf.status_code != 206:
+                        raise RangesIgnored(f'Server ignored byte range request for {url}')
+                    for data in DLf.iter_content(chunk_size=BLOCKSIZE):
+                        if abort.is_set():
+                            return
+                        buf += data[:hi + 1 - offset - len(buf)]
+                        if len(buf) >= WRITESIZE:
+                            offset += os.pwrite(fd, buf, offset)
+                            done[i] = offset - lo
+                            buf.clear()
+                            if offset - cached >= CACHESIZE:
+                                drop_cache(fd, cached, offset - cached)
+                                cached = offset
+                finally:  # keep what was received before an error
+                    if buf:
+                        offset += os.pwrite(fd, buf, offset)
+                        done[i] = offset - lo
+                    DLf.close()
+                if offset <= hi:
+                    raise IOError(f'Connection closed at byte {offset} of part {lo}-{hi}')
+            except RangesIgnored:
+                raise  # retrying won't help
+            except Exception as Ex:
+                tryouts += 1
+                if tryouts >= 5 or abort.is_set():
+                    raise
+                log.warning(f'Part {lo}-{hi}: {Ex}. Retry ({tryouts}/5)...')
+                if abort.wait(retry_after(Ex)):  # have a short resting time, unless another part failed
+                    return
+                self._ensure_token()
+
 
 def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
     log.setLevel(log_level)
@@ -242,8 +651,9 @@ def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
         ch = logging.StreamHandler(sys.stdout)
         ch.setLevel(log_level)
         ch.setFormatter(formatter)
-        if logging.StreamHandler not in [h.__class__ for h in log.handlers]:
+        if not getattr(log, '_sentinel_stream_added', False):
             log.addHandler(ch)
+            log._sentinel_stream_added = True
         else:
             log.warning('log Stream handler already applied.')
     if logfile:
@@ -253,8 +663,9 @@ def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
                                       utc=True)
         fh.setLevel(log_level)
         fh.setFormatter(formatter)
-        if TimedRotatingFileHandler not in [h.__class__ for h in log.handlers]:
+        if not getattr(log, '_sentinel_file_added', False):
             log.addHandler(fh)
+            log._sentinel_file_added = True
         else:
             log.warning('Log file handler already applied.')
         log.info(f'Log file is: {logfile}')
@@ -264,16 +675,13 @@ def set_logger(log, verbose=VERBOSE, log_level=LOG_LEVEL, logfile=LOG_FILE):
 if __name__=='__main__':
     args = parser.parse_args()
     set_logger(log, args.v, args.log_level, args.logfile)
-    client = SciHubClient(credfile=args.credfile, datapath=args.datapath) # create a client
+    client = SciHubClient(credfile=args.credfile, datapath=args.datapath, jobs=args.jobs, ca_bundle=args.ca_bundle,
+                          segments=args.segments) # create a client
     if args.aux:
         records = client.search_S1_SLC_OPER(start_date=args.start, end_date=args.end)
-        for record in records['value']:
-            client.download(record['Id'])
-            time.sleep(60)
+        client.download_all(records)
     records = client.search_S1_SLC_data(start_date=args.start, end_date=args.end, aoifile=args.geometry, direction=args.direction, track=args.track, online=args.online)
-    for record in records['value']:
-        client.download(record['Id'])
-        time.sleep(60)
+    client.download_all(records)
 
 """
 example:
@@ -284,7 +692,7 @@ args = parser.parse_args("--start 2023-09-01 --end 2023-11-01 --geometry NOVA.ge
 set_logger(log, True, 'DEBUG', args.logfile)
 self = client = SciHubClient() # create a client
 Id = 'a535c346-0212-42ae-a9ab-0a491f320d3b'
-records = client.search_S1_SLC_data(start_date=args.start, end_date=args.end, aoifile=args.geometry, direction=args.direction, track=args.track, online=args.online)
-Id = records['value'][0]['Id']
+records = list(client.search_S1_SLC_data(start_date=args.start, end_date=args.end, aoifile=args.geometry, direction=args.direction, track=args.track, online=args.online))
+Id = records[0]['Id']
 
 """